@@ -4,6 +4,7 @@
 A script to batch rename PDF files based on metadata/XMP title and author
 Requirements:
     - PDFMiner: https://github.com/pdfminer/pdfminer.six
+    - lxml (optional): https://lxml.de, used for faster XMP parsing
     - xmp: lightweight XMP parser from
         http://blog.matt-swain.com/post/25650072381/
             a-lightweight-xmp-parser-for-extracting-pdf-metadata-in
@@ -16,10 +17,15 @@ DATE = '2017-07-15'
 
 
 import os
-import sys
 import argparse
-import subprocess
-import glob
+import shutil
+import itertools
+import hashlib
+import sqlite3
+import mmap
+from contextlib import contextmanager
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # PDF and metadata libraries
 from pdfminer.pdfparser import PDFParser, PDFSyntaxError
@@ -32,11 +38,25 @@ By Matt Swain. Released under the MIT license:
 http://blog.matt-swain.com/post/25650072381/a-lightweight-xmp-parser-for-extracting-pdf-metadata-in
 """
 
-from collections import defaultdict
-from xml.etree import ElementTree as ET
+from io import BytesIO
+try:
+    from lxml import etree as ET
+    # XMP comes from untrusted PDFs; never expand external entities
+    _ITERPARSE_OPTS = {'resolve_entities': False, 'no_network': True}
+except ImportError:
+    from xml.etree import ElementTree as ET
+    _ITERPARSE_OPTS = {}
 
 RDF_NS = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
 XML_NS = '{http://www.w3.org/XML/1998/namespace}'
+_BAG = RDF_NS+'Bag'
+_SEQ = RDF_NS+'Seq'
+_ALT = RDF_NS+'Alt'
+_LI = RDF_NS+'li'
+_LANG = XML_NS+'lang'
+_RDF_DESC = [RDF_NS+'RDF', RDF_NS+'Description']  # parent path of a property
+_DC_TITLE = '{http://purl.org/dc/elements/1.1/}title'
+_DC_CREATOR = '{http://purl.org/dc/elements/1.1/}creator'
 NS_MAP = {
     'http://www.w3.org/1999/02/22-rdf-syntax-ns#'    : 'rdf',
     'http://purl.org/dc/elements/1.1/'               : 'dc',
@@ -50,6 +70,31 @@ NS_MAP = {
     'http://www.w3.org/XML/1998/namespace'           : 'xml'
 }
 
+def _iter_properties(xmp):
+    """ Stream the property elements of each rdf:Description under rdf:RDF. """
+    path = []
+    for event, el in ET.iterparse(BytesIO(xmp), events=('start', 'end'),
+                                  **_ITERPARSE_OPTS):
+        if event == 'start':
+            path.append(el.tag)
+            continue
+        path.pop()
+        if path[-2:] == _RDF_DESC:
+            yield el
+            el.clear()  # done with this subtree, free it
+
+def _parse_value(el):
+    """ Extract the metadata value from a property element. """
+    # One pass over the children instead of a find() per container type
+    for child in el:
+        tag = child.tag
+        if tag == _BAG or tag == _SEQ:
+            return [li.text for li in child if li.tag == _LI]
+        if tag == _ALT:
+            return dict((li.get(_LANG), li.text)
+                        for li in child if li.tag == _LI)
+    return el.text
+
 class XmpParser(object):
     """
     Parses an XMP string into a dictionary.
@@ -59,19 +104,18 @@ class XmpParser(object):
     """
 
     def __init__(self, xmp):
-        self.tree = ET.XML(xmp)
-        self.rdftree = self.tree.find(RDF_NS+'RDF')
+        if isinstance(xmp, str):
+            xmp = xmp.encode('utf-8')
+        self.xmp = xmp
 
     @property
     def meta(self):
         """ A dictionary of all the parsed metadata. """
-        meta = defaultdict(dict)
-        for desc in self.rdftree.findall(RDF_NS+'Description'):
-            for el in list(desc):
-                ns, tag =  self._parse_tag(el)
-                value = self._parse_value(el)
-                meta[ns][tag] = value
-        return dict(meta)
+        meta = {}
+        for el in _iter_properties(self.xmp):
+            ns, tag =  self._parse_tag(el)
+            meta.setdefault(ns, {})[tag] = _parse_value(el)
+        return meta
 
     def _parse_tag(self, el):
         """ Extract the namespace and tag from an element. """
@@ -79,47 +123,67 @@ class XmpParser(object):
         tag = el.tag
         if tag[0] == "{":
             ns, tag = tag[1:].split('}',1)
-            if ns in NS_MAP:
-                ns = NS_MAP[ns]
+            ns = NS_MAP.get(ns, ns)
         return ns, tag
 
-    def _parse_value(self, el):
-        """ Extract the metadata value from an element. """
-        if el.find(RDF_NS+'Bag') is not None:
-            value = []
-            for li in el.findall(RDF_NS+'Bag/'+RDF_NS+'li'):
-                value.append(li.text)
-        elif el.find(RDF_NS+'Seq') is not None:
-            value = []
-            for li in el.findall(RDF_NS+'Seq/'+RDF_NS+'li'):
-                value.append(li.text)
-        elif el.find(RDF_NS+'Alt') is not None:
-            value = {}
-            for li in el.findall(RDF_NS+'Alt/'+RDF_NS+'li'):
-                value[li.get(XML_NS+'lang')] = li.text
-        else:
-            value = el.text
-        return value
-
 def xmp_to_dict(xmp):
     """ Shorthand function for parsing an XMP string into a python dictionary. """
     return XmpParser(xmp).meta
 
+def xmp_title_creator(xmp):
+    """
+    Parse only dc:title and dc:creator from an XMP string, stopping as soon
+    as both are found. Missing properties come back as None.
+    """
+    found = {}
+    for el in _iter_properties(xmp):
+        if el.tag == _DC_TITLE or el.tag == _DC_CREATOR:
+            found[el.tag] = _parse_value(el)
+            if len(found) == 2:
+                break
+    return found.get(_DC_TITLE), found.get(_DC_CREATOR)
+
+
+class _SanitizeTable(dict):
+    """ str.translate table that deletes disallowed characters, filled lazily. """
+    keep = frozenset(" ._-\u2014")
+
+    def __missing__(self, cp):
+        c = chr(cp)
+        v = self[cp] = c if c in self.keep or c.isalnum() else None
+        return v
+
+class _TitleTable(_SanitizeTable):
+    """ As _SanitizeTable, but also lowercases and turns whitespace into dashes. """
+
+    def __missing__(self, cp):
+        c = chr(cp)
+        if c.isspace():
+            v = '-'
+        elif c in self.keep or c.isalnum():
+            v = c.lower()
+        else:
+            v = None
+        self[cp] = v
+        return v
+
+_SANITIZE_TABLE = _SanitizeTable()
+_TITLE_TABLE = _TitleTable()
 
 def _sanitize(s):
-    keep = [" ", ".", "_", "-", "\u2014"]
-    return "".join([x for x in s if x in keep or x.isalnum()]).strip()
+    return s.translate(_SANITIZE_TABLE).strip()
 
 def _get_metadata(f):
+    # PDFDocument only reads the xref, trailer and catalog up front, and
+    # already binds itself to the parser; nothing touches the page tree.
     parser = PDFParser(f)
     try:
         doc = PDFDocument(parser)
     except PDFSyntaxError:
-        return {}
-    parser.set_document(doc)
+        return None
 
-    if not hasattr(doc, 'info') or len(doc.info) == 0:
-        return {}
+    if not doc.info:
+        return None
     return doc
 
 def _resolve_objref(ref):
@@ -127,83 +191,106 @@ def _resolve_objref(ref):
         return ref.resolve()
     return ref
 
+def _to_str(v):
+    """ Return str as-is, UTF-8 decode bytes, and None for anything else. """
+    if isinstance(v, str):
+        return v
+    if isinstance(v, (bytes, bytearray)):
+        return v.decode('utf-8')
+    return None
+
 def _au_last_name(name):
     return name.split()[-1]
 
-def _get_xmp_metadata(doc):
+def _get_xmp_metadata(metadata):
     t = a = None
-    metadata = resolve1(doc.catalog['Metadata']).get_data()
-    try:
-        md = xmp_to_dict(metadata)
-    except:
+    # Don't bother the XML parser with streams that are plainly not XMP
+    if not metadata or b'RDF' not in metadata[:4096]:
         return t, a
-
     try:
-        t = md['dc']['title']['x-default']
-    except TypeError:
-        # The 'title' field might be a string or bytes instead of a dict
-        # https://github.com/jdmonaco/pdf-title-rename/issues/7
-        titleval = md['dc']['title']
-        if type(titleval) is str:
-            t = titleval
-        elif type(titleval) is bytes:
-            t = titleval.decode()
-    except KeyError:
-        pass
+        titleval, creator = xmp_title_creator(metadata)
+    except (ET.ParseError, ValueError, LookupError):
+        # stdlib ElementTree raises ValueError for multi-byte encodings
+        # and LookupError for unknown ones
+        return t, a
 
-    try:
-        a = md['dc']['creator']
-    except KeyError:
-        pass
+    # The 'title' field might be a string or bytes instead of a dict
+    # https://github.com/jdmonaco/pdf-title-rename/issues/7
+    if isinstance(titleval, dict):
+        titleval = titleval.get('x-default')
+    t = _to_str(titleval)
+
+    if isinstance(creator, dict):
+        creator = list(creator.values())
+    elif not isinstance(creator, list):
+        creator = [_to_str(creator)]
+    a = [c for c in creator if c and c.strip()]  # drop None, blank names
+    if len(a) > 1:
+        a = '%s %s' % (_au_last_name(a[0]), _au_last_name(a[-1]))
+    elif len(a) == 1:
+        a = _au_last_name(a[0])
     else:
-        if type(a) is bytes:
-            a = a.decode('utf-8')
-        if type(a) is str:
-            a = [a]
-        a = list(filter(bool, a))  # remove None, empty strings, ...
-        if len(a) > 1:
-            a = '%s %s' % (_au_last_name(a[0]), _au_last_name(a[-1]))
-        elif len(a) == 1:
-            a = _au_last_name(a[0])
-        else:
-            a = None
+        a = None
 
     return t, a
 
-def _get_info(fn):
-    title = author = None
+@contextmanager
+def _open_pdf(fn):
+    """ Open a PDF memory-mapped, so pdfminer's seeks are just pointer moves. """
     with open(fn, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # empty file, or a filesystem (FUSE, some network mounts)
+            # that cannot mmap; read it the ordinary way
+            yield f
+            return
+        with mm:
+            yield mm
+
+def _warn(log, msg):
+    """ Print msg, or collect it in log for the parent process to print. """
+    if log is None:
+        print(msg)
+    else:
+        log.append(msg)
+
+def _get_info(fn, force_xmp=False, log=None):
+    title = author = None
+    with _open_pdf(fn) as f:
         doc = _get_metadata(f)
-        
+        if not doc:
+            return title, author
+
         info = doc.info[0]
         if 'Title' in info:
             ti = _resolve_objref(info['Title'])
             try:
-                title = ti.decode('utf-8')
-            except AttributeError:
-                pass
+                title = _to_str(ti)
             except UnicodeDecodeError:
-                print(' -- Could not decode title bytes: %r' % ti)
+                _warn(log, ' -- Could not decode title bytes: %r' % ti)
         
         if 'Author' in info:
             au = _resolve_objref(info['Author'])
             try:
-                author = au.decode('utf-8')
-            except AttributeError:
-                pass
+                author = _to_str(au)
             except UnicodeDecodeError:
-                print(' -- Could not decode title bytes: %r' % au)
+                _warn(log, ' -- Could not decode author bytes: %r' % au)
                 
-        if 'Metadata' in doc.catalog:
-            xmpt, xmpa = _get_xmp_metadata(doc)
-            xmpt = _resolve_objref(xmpt)
-            xmpa = _resolve_objref(xmpa)
+        # XMP values win over Info, but the XMP stream is the costly read;
+        # skip it when Info already has a usable title and author.
+        mdref = doc.catalog.get('Metadata')
+        info_title = title.strip() if title else ''
+        info_done = (author and author.strip() and info_title and
+                     info_title.lower() != 'untitled')
+        if mdref is not None and (force_xmp or not info_done):
+            xmpt, xmpa = _get_xmp_metadata(resolve1(mdref).get_data())
             if xmpt:
                 title = xmpt
             if xmpa:
                 author = xmpa
                 
-    if type(title) is str:
+    if title is not None:
         title = title.strip()
         if title.lower() == 'untitled':
             title = None
@@ -214,59 +301,172 @@ def _get_info(fn):
     return title, author
 
 def _new_filename(title, author=None):
-    title = title.lower().replace(":", "")
-    
-    n = _sanitize(title)
-    n = "-".join(title.strip().split(" "))
+    """ Build the new file name, or None if the title has nothing usable. """
+    # No leading dots on either part, or the result is a hidden file
+    n = title.translate(_TITLE_TABLE).strip('-').lstrip('.')
+    if not n:
+        return None
     if author is not None:
-        author = author.lower()
-        n = '%s.%s' % (_sanitize(author).lower(), n)
+        au = _sanitize(author).lstrip('.').lower()
+        if au:
+            n = '%s.%s' % (au, n)
     n = '%s.pdf' % n[:250]  # limit filenames to ~255 chars
     return n
 
-def main(dir, is_author=False, destination=None):
+def _iter_pdfs(d):
+    """ Yield the PDF files in a directory as they are found. """
+    with os.scandir(d) as it:
+        for e in it:
+            if e.name.startswith('.'):
+                continue  # hidden, glob's '*' never matched these
+            if e.name.lower().endswith('.pdf') and e.is_file():
+                yield e.path
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'pdf_rename.db')
+
+def _file_key(fn):
+    """ Cheap content fingerprint: hash of the first 64 KB plus the size. """
+    with open(fn, "rb") as f:
+        head = f.read(65536)
+    h = hashlib.blake2b(head)
+    h.update(str(os.path.getsize(fn)).encode())
+    return h.hexdigest()
+
+def _open_cache(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=30)
+    db.execute('CREATE TABLE IF NOT EXISTS info '
+               '(hash TEXT PRIMARY KEY, title TEXT, author TEXT)')
+    return db
+
+# Per-worker cache connection, see _init_worker. Thread-local so that
+# thread pool workers each get their own, as sqlite3 requires.
+_worker = threading.local()
+
+def _init_worker(cache_path):
+    _worker.cache = sqlite3.connect(cache_path, timeout=30) if cache_path else None
+
+def _cached_info(fn, force_xmp=False, log=None):
+    """
+    Return (title, author, entry) for a file, using the cache if possible.
+    entry is the (hash, title, author) row to store, or None on a cache hit.
+    """
+    cache = getattr(_worker, 'cache', None)
+    if cache is None:
+        return _get_info(fn, force_xmp, log) + (None,)
+    key = _file_key(fn)
+    if force_xmp:
+        key += '-xmp'  # may differ from the Info-only answer
+    row = cache.execute('SELECT title, author FROM info WHERE hash = ?',
+                         (key,)).fetchone()
+    if row is not None:
+        return row[0], row[1], None
+    title, author = _get_info(fn, force_xmp, log)
+    return title, author, (key, title, author)
+
+def _compute_rename(f, is_author=False, force_xmp=False):
+    """
+    Parse one file and work out its new name; runs in a pool worker.
+    Returns (f, newf, status, entry, log) where entry is a new cache row or
+    None, and log holds warnings for the parent to print with the file.
+    """
+    log = []
+    root, ext = os.path.splitext(f)
+    path, base = os.path.split(root)
+    try:
+        title, author, entry = _cached_info(f, force_xmp, log)
+    except Exception as e:
+        # e.g. PSEOF on a truncated file; don't let one file sink the batch
+        log.append(' -- Error reading file: %r' % e)
+        return f, None, 'error', None, log
+    if author and not title:
+        title = base
+    if not (author or title):
+        return f, None, 'missing', entry, log
+    if not is_author:
+        author = None
+    newname = _new_filename(title, author)
+    if newname is None:
+        # Title was all punctuation; keep the old name as the title part
+        newname = _new_filename(base, author)
+    if newname is None:
+        return f, None, 'missing', entry, log
+    return f, os.path.join(path, newname), 'ok', entry, log
+
+def main(dir, is_author=False, destination=None, cache=CACHE_PATH,
+         threads=False, force_xmp=False):
     
-    files = glob.glob(os.path.join(dir, f"*.pdf"))
-    Ntot = len(files)
+    if cache:
+        try:
+            db = _open_cache(cache)
+        except (OSError, sqlite3.Error) as e:
+            print(' -- Cannot open metadata cache %s (%s), continuing without it'
+                  % (cache, e))
+            cache = None
+    entries = []
+    Ntot = 0
     Nmissing = 0
     Nfiled = 0
     Nerrors = 0
     Nrenamed = 0
-    # print(files)
-    for f in files:
-        print(f)
-        root, ext = os.path.splitext(f)
-        path, base = os.path.split(root)
-        title, author = _get_info(f)
-        # print(title, author)
-        if author and not title:
-            title = base
-        if not (author or title):
-            print(' -- Could not find metadata in the file')
-            Nmissing += 1
-            continue
-        if is_author:
-            newf = os.path.join(path, _new_filename(title, author))
-        else:
-            newf = os.path.join(path, _new_filename(title))
-        # print(newf)
-        try:
-            os.rename(f, newf)
-        except OSError:
-            print(' -- Error renaming file, maybe it moved?')
-            Nerrors += 1
-            continue
-        else:
-            Nrenamed += 1
-
-        if destination:
-            if subprocess.call(['mv', newf, destination]) == 0:
-                print(' -- Filed to', destination)
-                Nfiled += 1
-            else:
-                print(' -- Error moving file')
-                Nerrors += 1
-            print(' - Filed: %d' % Nfiled)
+    # Parsing runs in the pool; renames and moves stay in this process.
+    # map() drains the directory scan before yielding, so renames below
+    # can never be picked up again as new files.
+    # Threads suit slow or remote storage, where waiting on reads rather
+    # than parsing dominates; processes are better for CPU-bound parsing.
+    if threads:
+        executor = ThreadPoolExecutor(initializer=_init_worker,
+                                      initargs=(cache,))
+    else:
+        executor = ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                       initializer=_init_worker,
+                                       initargs=(cache,))
+    # Rows parsed so far are kept even if the run is interrupted
+    try:
+        with executor:
+            results = executor.map(_compute_rename, _iter_pdfs(dir),
+                                   itertools.repeat(is_author),
+                                   itertools.repeat(force_xmp), chunksize=8)
+            for f, newf, status, entry, log in results:
+                print(f)
+                Ntot += 1
+                for msg in log:
+                    print(msg)
+                if status == 'error':
+                    Nerrors += 1
+                    continue
+                if entry is not None:
+                    entries.append(entry)
+                if status == 'missing':
+                    print(' -- Could not find metadata in the file')
+                    Nmissing += 1
+                    continue
+                # print(newf)
+                try:
+                    os.rename(f, newf)
+                except OSError:
+                    print(' -- Error renaming file, maybe it moved?')
+                    Nerrors += 1
+                    continue
+                else:
+                    Nrenamed += 1
+
+                if destination:
+                    try:
+                        shutil.move(newf, destination)
+                    except OSError:
+                        print(' -- Error moving file')
+                        Nerrors += 1
+                    else:
+                        print(' -- Filed to', destination)
+                        Nfiled += 1
+                    print(' - Filed: %d' % Nfiled)
+    finally:
+        if cache:
+            with db:
+                db.executemany('INSERT OR REPLACE INTO info VALUES (?, ?, ?)',
+                               entries)
+            db.close()
     print('Processed %d files:' % Ntot)
     print(' - Renamed: %d' % Nrenamed)
     print(' - Missing metadata: %d' % Nmissing)
@@ -274,5 +474,20 @@ def main(dir, is_author=False, destination=None):
         
     return None
 
-dir = sys.argv[1] 
-main(dir)
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog=NAME, description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dir', help='directory of PDF files to rename')
+    parser.add_argument('--no-cache', dest='cache', action='store_const',
+                        const=None, default=CACHE_PATH,
+                        help='do not read or update the metadata cache '
+                             '(%s)' % CACHE_PATH)
+    parser.add_argument('--threads', action='store_true',
+                        help='parse with a thread pool instead of processes '
+                             '(for PDFs on slow or network storage)')
+    parser.add_argument('--force-xmp', action='store_true',
+                        help='always read XMP metadata, even when the Info '
+                             'dictionary already has a title and author')
+    args = parser.parse_args()
+    main(args.dir, cache=args.cache, threads=args.threads,
+         force_xmp=args.force_xmp)